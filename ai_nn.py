@@ -6,6 +6,7 @@ import time
 import random
 from pyax12.connection import Connection
 from weapon import WeaponArm
+import live_profiler
 from datetime import datetime,timedelta
 import neural_net
 h_fov = 78.0  # TODO: Read this in from config.txt and calculate real horizontal angle
@@ -19,6 +20,7 @@ last_power = 10000
 
 def main():
     signal.signal(signal.SIGINT, exit_gracefully)
+    live_profiler.install()
     # Take in 3 arguments: usually front.txt, back.txt, heading.txt
     if len(sys.argv) != 4:
         print("This requires 3 arguments: the front input file, the back input file, and the output file")
@@ -27,6 +27,9 @@ using namespace std;
 #include <memory>
 #include <atomic>
 #include <mutex>
+#include <condition_variable>
+#include <chrono>
+#include <algorithm>
 
 const string usage = "\n"
   "Usage:\n"
@@ -46,7 +49,11 @@ const string usage = "\n"
   "  -G <gain>       Manually set camera gain (default auto; range 0-255)\n"
   "  -B <brightness> Manually set the camera brightness (default 128; range 0-255)\n"
   "  -N <camera number> Set camera number (1 for front, 2 for back)\n"
-  "  -n <config file> Read in camera config from given config file. Must come after -N"
+  "  -n <config file> Read in camera config from given config file. Must come after -N\n"
+  "  -T <frames>     Track tags in regions of interest, full frame scan every <frames> frames\n"
+  "  -P <pixels>     Padding around tracked tags for region of interest scans (default 40)\n"
+  "  -M <factor>     Detect on an image decimated by <factor> first (default 1, i.e. off)\n"
+  "  -R <meters>     With -M, go straight to full resolution when the last tag was farther (default 1.5)\n"
   "\n";
 
 #ifndef __APPLE__
@@ -117,19 +124,102 @@ void wRo_to_euler(const Eigen::Matrix3d& wRo, double& yaw, double& pitch, double
     roll  = standardRad(atan2(wRo(0,2)*s - wRo(1,2)*c, -wRo(0,1)*s + wRo(1,1)*c));
 }
 
+/**
+ * Intersection of the tag's diagonals, i.e. the projected center of the tag.
+ */
+pair<float,float> diagonalIntersection(const pair<float,float> p[4]) {
+  // solve p0 + t*(p2 - p0) = p1 + s*(p3 - p1) for t
+  float d1x = p[2].first - p[0].first, d1y = p[2].second - p[0].second;
+  float d2x = p[3].first - p[1].first, d2y = p[3].second - p[1].second;
+  float denominator = d1x*d2y - d1y*d2x;
+  if (denominator == 0) {
+    return make_pair((p[0].first + p[2].first)/2, (p[0].second + p[2].second)/2);
+  }
+  float t = ((p[1].first - p[0].first)*d2y - (p[1].second - p[0].second)*d2x) / denominator;
+  return make_pair(p[0].first + t*d1x, p[0].second + t*d1y);
+}
+
+/**
+ * Shift a detection found in a sub-image back into full-frame pixel coordinates.
+ */
+void offsetDetection(AprilTags::TagDetection& detection, float dx, float dy) {
+  for (int i = 0; i < 4; i++) {
+    detection.p[i].first += dx;
+    detection.p[i].second += dy;
+  }
+  detection.cxy.first += dx;
+  detection.cxy.second += dy;
+  // the homography is relative to hxy, so moving hxy moves interpolate() too
+  detection.hxy.first += dx;
+  detection.hxy.second += dy;
+}
+
+/**
+ * Scale a detection found in a decimated image back up to full resolution.
+ * A decimated pixel u covers full resolution pixels factor*u ... factor*u + factor-1,
+ * so its center is at factor*u + (factor-1)/2.
+ */
+void scaleDetection(AprilTags::TagDetection& detection, float factor) {
+  const float offset = (factor - 1) / 2;
+  for (int i = 0; i < 4; i++) {
+    detection.p[i].first = detection.p[i].first*factor + offset;
+    detection.p[i].second = detection.p[i].second*factor + offset;
+  }
+  detection.cxy.first = detection.cxy.first*factor + offset;
+  detection.cxy.second = detection.cxy.second*factor + offset;
+  // interpolate() adds hxy after the homography, so scaling rows 0 and 1 and
+  // moving hxy maps it to full resolution as well
+  detection.hxy.first = detection.hxy.first*factor + offset;
+  detection.hxy.second = detection.hxy.second*factor + offset;
+  detection.homography.row(0) *= factor;
+  detection.homography.row(1) *= factor;
+  detection.observedPerimeter *= factor;
+}
+
 bool break_camera_loop = false;
 
+// A captured image together with its position in the capture stream
+struct CameraFrame {
+  cv::Mat image;
+  unsigned long sequence; // 0 means no frame yet, first captured frame is 1
+  double timestamp; // tic() at capture time
+
+  CameraFrame() : sequence(0), timestamp(0) {}
+};
+
 class CameraUpdater {
   private:
   cv::VideoCapture m_cap;
   int camera_number;
-  cv::Mat latest_picture;
+  // Three frames rotate between the capture thread, the latest slot and the
+  // consumer by swapping, so their Mat buffers are reused instead of reallocated
+  CameraFrame capture_frame;
+  CameraFrame latest_frame;
+  unsigned long next_sequence;
   thread updater_thread;
   atomic<bool> thread_is_running;
   mutex picture_lock;
+  condition_variable picture_ready;
+
+  // frames overwritten before anyone took them
+  atomic<unsigned long> dropped_frames;
+  // times the consumer asked for a frame before a newer one had arrived
+  atomic<unsigned long> duplicate_frames;
+  // sequence of the consumer's frame when it last had to wait, so timeout
+  // retries on the same frame aren't counted again
+  unsigned long waited_on_sequence;
+
+  // Caller must hold picture_lock
+  void publish(CameraFrame& frame) {
+    frame.sequence = next_sequence++;
+    if (latest_frame.sequence != 0) dropped_frames++;
+    swap(latest_frame, frame);
+  }
 
   public:
-  CameraUpdater(int camera_number) : camera_number(camera_number), m_cap(camera_number), thread_is_running(false) {
+  CameraUpdater(int camera_number) : camera_number(camera_number), m_cap(camera_number), next_sequence(1),
+                                     thread_is_running(false), dropped_frames(0), duplicate_frames(0),
+                                     waited_on_sequence(0) {
     thread_is_running = true;
     if (!m_cap.isOpened()) {
       cerr << "Capture device not opened" << endl;
@@ -144,41 +234,68 @@ class CameraUpdater {
 
   ~CameraUpdater() {
     thread_is_running = false;
+    picture_ready.notify_all();
     updater_thread.join();
     m_cap.release();
   }
 
   void update_camera() {
     while (thread_is_running) {
-      cv::Mat picture;
-      bool read_picture = m_cap.read(picture);
+      // read() reuses capture_frame's buffer as long as the size doesn't change
+      bool read_picture = m_cap.read(capture_frame.image);
       if (!read_picture) {
         cerr << "Could not read picture" << endl;
         continue;
       }
-      picture_lock.lock();
-      latest_picture = picture;
-      picture_lock.unlock();
+      capture_frame.timestamp = tic();
+      {
+        lock_guard<mutex> lock(picture_lock);
+        publish(capture_frame);
+      }
+      picture_ready.notify_one();
     }
   }
   
   void start() {
     thread_is_running = true;
     picture_lock.lock();
-    bool picture_grabbed = m_cap.read(latest_picture);
+    bool picture_grabbed = m_cap.read(capture_frame.image);
     if (!picture_grabbed) {
       cerr << "Could not grab picture" << endl;
       exit(1);
     }
+    capture_frame.timestamp = tic();
+    publish(capture_frame);
     picture_lock.unlock();
     updater_thread = thread([this] { this->update_camera(); });
   }
   
-  cv::Mat get_picture() {
-    picture_lock.lock();
-    cv::Mat picture = latest_picture;
-    picture_lock.unlock();
-    return picture;
+  // Waits up to timeout seconds for a frame newer than the one in frame and
+  // swaps it in. Returns false if no new frame arrived in time, leaving frame as is.
+  bool get_picture(CameraFrame& frame, double timeout) {
+    unique_lock<mutex> lock(picture_lock);
+    if (latest_frame.sequence <= frame.sequence) {
+      if (waited_on_sequence != frame.sequence) {
+        duplicate_frames++;
+        waited_on_sequence = frame.sequence;
+      }
+      bool got_frame = picture_ready.wait_for(lock, chrono::duration<double>(timeout), [this, &frame] {
+        return latest_frame.sequence > frame.sequence || !thread_is_running;
+      });
+      if (!got_frame || latest_frame.sequence <= frame.sequence) return false;
+    }
+    swap(frame, latest_frame);
+    // the consumer's old frame is now in the latest slot; mark it as taken
+    latest_frame.sequence = 0;
+    return true;
+  }
+
+  unsigned long get_dropped_frames() const {
+    return dropped_frames;
+  }
+
+  unsigned long get_duplicate_frames() const {
+    return duplicate_frames;
   }
 };
 
@@ -215,6 +332,23 @@ class Demo {
 
   CameraUpdater *m_camera_updater;
 
+  int m_track_interval; // full frame scan every this many frames when tracking, 0 disables tracking
+  int m_roi_padding; // pixels added around a tracked tag's corners
+  vector<cv::Rect> m_tracks; // regions of interest around the last detections
+  int m_frames_since_full_scan;
+  long m_full_scans;
+  long m_roi_scans;
+  cv::Mat m_roi_gray; // extractTags needs a continuous image, so ROIs are copied here
+
+  int m_decimation; // full frame scans try an image this many times smaller first, 1 disables
+  double m_far_distance; // meters; a nearest tag beyond this skips the decimated scan
+  double m_nearest_distance; // distance to the closest tag of the last successful full frame scan
+  cv::Mat m_decimated_gray;
+  long m_decimated_scans;
+  long m_full_res_scans;
+  double m_decimated_time; // total seconds spent per scale
+  double m_full_res_time;
+
 public:
 
   // default constructor
@@ -242,7 +376,21 @@ public:
     m_deviceId(0),
     m_camera_number(0),
     m_camera_name(""),
-    m_camera_updater(nullptr)
+    m_camera_updater(nullptr),
+
+    m_track_interval(0),
+    m_roi_padding(40),
+    m_frames_since_full_scan(0),
+    m_full_scans(0),
+    m_roi_scans(0),
+
+    m_decimation(1),
+    m_far_distance(1.5),
+    m_nearest_distance(0),
+    m_decimated_scans(0),
+    m_full_res_scans(0),
+    m_decimated_time(0),
+    m_full_res_time(0)
 
   {
     m_camera_matrix = (cv::Mat_<double>(3, 3) << 462.63107599, 0.,           326.21297766,
@@ -278,7 +426,8 @@ public:
   // parse command line options to change default behavior
   void parseOptions(int argc, char* argv[]) {
     int c;
-    while ((c = getopt(argc, argv, ":h?dtn:N:C:F:H:S:W:E:G:B:D:")) != -1) {
+    char* end;
+    while ((c = getopt(argc, argv, ":h?dtn:N:C:F:H:S:W:E:G:B:D:T:P:M:R:")) != -1) {
       // Each option character has to be in the string in getopt();
       // the first colon changes the error character from '?' to ':';
       // a colon after an option means that there is an extra
@@ -353,6 +502,34 @@ public:
         }
         m_camera_name = (m_camera_number == 1) ? "Front" : "Back";
         break;
+      case 'T':
+        m_track_interval = strtol(optarg, nullptr, 0);
+        if (m_track_interval < 1) {
+            cout << "Error: tracking interval must be at least 1 frame" << endl;
+            exit(1);
+        }
+        break;
+      case 'P':
+        m_roi_padding = strtol(optarg, &end, 0);
+        if (*end != '\0' || m_roi_padding < 0) {
+            cout << "Error: region of interest padding must be 0 or more pixels" << endl;
+            exit(1);
+        }
+        break;
+      case 'M':
+        m_decimation = strtol(optarg, nullptr, 0);
+        if (m_decimation < 1) {
+            cout << "Error: decimation factor must be at least 1" << endl;
+            exit(1);
+        }
+        break;
+      case 'R':
+        m_far_distance = strtod(optarg, &end);
+        if (*end != '\0' || !(m_far_distance > 0)) {
+            cout << "Error: far tag distance must be more than 0 meters" << endl;
+            exit(1);
+        }
+        break;
       case ':': // unknown option, from getopt
         cout << usage;
         exit(1);
@@ -535,6 +712,138 @@ public:
     // for suitable factors.
   }
 
+  // Distance in meters from the camera to the closest detection
+  double nearestDistance(const vector<AprilTags::TagDetection>& detections) const {
+    double nearest = INFINITY;
+    for (int i = 0; i < detections.size(); i++) {
+      Eigen::Vector3d translation;
+      Eigen::Matrix3d rotation;
+      detections[i].getRelativeTranslationRotation(m_tagSize, m_fx, m_fy, m_px, m_py, translation, rotation);
+      nearest = min(nearest, translation.norm());
+    }
+    return nearest;
+  }
+
+  // Detect on the decimated image, then refine the corners at full resolution
+  // so distances from getRelativeTranslationRotation stay accurate
+  vector<AprilTags::TagDetection> extractDecimatedTags(const cv::Mat& image_gray) {
+    cv::resize(image_gray, m_decimated_gray, cv::Size(), 1.0/m_decimation, 1.0/m_decimation, cv::INTER_AREA);
+    vector<AprilTags::TagDetection> detections = m_tagDetector->extractTags(m_decimated_gray);
+
+    for (int i = 0; i < detections.size(); i++) {
+      scaleDetection(detections[i], m_decimation);
+
+      vector<cv::Point2f> corners;
+      for (int j = 0; j < 4; j++) {
+        corners.push_back(cv::Point2f(detections[i].p[j].first, detections[i].p[j].second));
+      }
+      cv::cornerSubPix(image_gray, corners, cv::Size(m_decimation + 1, m_decimation + 1), cv::Size(-1, -1),
+                       cv::TermCriteria(cv::TermCriteria::EPS + cv::TermCriteria::COUNT, 10, 0.01));
+      for (int j = 0; j < 4; j++) {
+        detections[i].p[j] = make_pair(corners[j].x, corners[j].y);
+      }
+      // the heading written to the output file comes from cxy, so take it
+      // from the same refined corners the distance is computed from
+      detections[i].cxy = diagonalIntersection(detections[i].p);
+    }
+    return detections;
+  }
+
+  // Scan the whole frame. Close tags are big, so the decimated image is tried
+  // first; full resolution is only used when that finds nothing or the last
+  // tag we saw was far away.
+  vector<AprilTags::TagDetection> extractFrameTags(const cv::Mat& image_gray) {
+    vector<AprilTags::TagDetection> detections;
+    double t0;
+
+    if (m_decimation > 1 && m_nearest_distance <= m_far_distance) {
+      t0 = tic();
+      detections = extractDecimatedTags(image_gray);
+      m_decimated_time += tic() - t0;
+      m_decimated_scans++;
+    }
+    if (detections.empty()) {
+      t0 = tic();
+      detections = m_tagDetector->extractTags(image_gray);
+      m_full_res_time += tic() - t0;
+      m_full_res_scans++;
+    }
+
+    if (m_decimation > 1 && !detections.empty()) {
+      m_nearest_distance = nearestDistance(detections);
+    }
+    return detections;
+  }
+
+  // Padded bounding box of a detection's corners, clipped to the image
+  cv::Rect trackRegion(const AprilTags::TagDetection& detection, const cv::Mat& image_gray) const {
+    float min_x = detection.p[0].first, max_x = min_x;
+    float min_y = detection.p[0].second, max_y = min_y;
+    for (int i = 1; i < 4; i++) {
+      min_x = min(min_x, detection.p[i].first);
+      max_x = max(max_x, detection.p[i].first);
+      min_y = min(min_y, detection.p[i].second);
+      max_y = max(max_y, detection.p[i].second);
+    }
+    cv::Rect region(cv::Point(floor(min_x) - m_roi_padding, floor(min_y) - m_roi_padding),
+                    cv::Point(ceil(max_x) + m_roi_padding + 1, ceil(max_y) + m_roi_padding + 1));
+    return region & cv::Rect(0, 0, image_gray.cols, image_gray.rows);
+  }
+
+  // Look for tags only around the previous detections. Returns false if a
+  // track was lost, in which case the caller should scan the full frame.
+  bool extractTrackedTags(const cv::Mat& image_gray, vector<AprilTags::TagDetection>& detections) {
+    for (int i = 0; i < m_tracks.size(); i++) {
+      if (m_tracks[i].area() == 0) return false;
+      image_gray(m_tracks[i]).copyTo(m_roi_gray);
+      vector<AprilTags::TagDetection> roi_detections = m_tagDetector->extractTags(m_roi_gray);
+      if (roi_detections.empty()) return false;
+
+      for (int j = 0; j < roi_detections.size(); j++) {
+        offsetDetection(roi_detections[j], m_tracks[i].x, m_tracks[i].y);
+
+        // neighbouring regions can overlap, keep each tag only once
+        bool duplicate = false;
+        for (int k = 0; k < detections.size(); k++) {
+          if (detections[k].id == roi_detections[j].id && detections[k].overlapsTooMuch(roi_detections[j])) {
+            duplicate = true;
+            break;
+          }
+        }
+        if (!duplicate) detections.push_back(roi_detections[j]);
+      }
+    }
+    return true;
+  }
+
+  // Detect tags in the whole frame, or only around known tags when tracking is enabled
+  vector<AprilTags::TagDetection> detectTags(const cv::Mat& image_gray) {
+    if (m_track_interval == 0) {
+      m_full_scans++;
+      return extractFrameTags(image_gray);
+    }
+
+    vector<AprilTags::TagDetection> detections;
+    bool tracked = false;
+    if (!m_tracks.empty() && m_frames_since_full_scan < m_track_interval) {
+      tracked = extractTrackedTags(image_gray, detections);
+    }
+    if (tracked) {
+      m_roi_scans++;
+      m_frames_since_full_scan++;
+    } else {
+      m_full_scans++;
+      m_frames_since_full_scan = 1;
+      detections = extractFrameTags(image_gray);
+    }
+
+    m_tracks.clear();
+    for (int i = 0; i < detections.size(); i++) {
+      m_tracks.push_back(trackRegion(detections[i], image_gray));
+    }
+    return detections;
+  }
+
   void processImage(cv::Mat& image, cv::Mat& image_gray) {
     // alternative way is to grab, then retrieve; allows for
     // multiple grab when processing below frame rate - v4l keeps a
@@ -552,7 +861,7 @@ public:
       t0 = tic();
     }
 
-    vector<AprilTags::TagDetection> detections = m_tagDetector->extractTags(image_gray);
+    vector<AprilTags::TagDetection> detections = detectTags(image_gray);
     if (m_timing) {
       double dt = tic()-t0;
       cout << "Extracting tags took " << dt << " seconds." << endl;
@@ -601,7 +910,7 @@ public:
     m_camera_updater->start();
     cout << "Started updater" << endl;
 
-    cv::Mat image;
+    CameraFrame camera_frame;
     cv::Mat image_gray;
 
     int frame = 0;
@@ -609,18 +918,27 @@ public:
 
     while (!break_camera_loop) {
 
-      // capture frame
-      image = m_camera_updater->get_picture();
-      cerr << "Got image" << endl;
+      // wait for a frame we haven't processed yet
+      if (!m_camera_updater->get_picture(camera_frame, 0.1)) continue;
 
-      processImage(image, image_gray);
-      cerr << "Processed image" << endl;
+      processImage(camera_frame.image, image_gray);
 
       // print out the frame rate at which image frames are being processed
       frame++;
       if (frame % 10 == 0) {
         double t = tic();
         cout << "  " << 10./(t-last_t) << " fps" << endl;
+        cout << "  " << m_camera_updater->get_dropped_frames() << " dropped frames, "
+             << m_camera_updater->get_duplicate_frames() << " duplicate frames" << endl;
+        if (m_track_interval > 0) {
+          cout << "  " << m_full_scans << " full scans, " << m_roi_scans << " tracked scans" << endl;
+        }
+        if (m_decimation > 1) {
+          cout << "  1/" << m_decimation << " scale: " << m_decimated_scans << " scans, "
+               << (m_decimated_scans ? m_decimated_time/m_decimated_scans : 0) << " s avg; "
+               << "full scale: " << m_full_res_scans << " scans, "
+               << (m_full_res_scans ? m_full_res_time/m_full_res_scans : 0) << " s avg" << endl;
+        }
         last_t = t;
       }
 
@@ -0,0 +1,118 @@
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+
+# Send these to a running ai.py / ai_nn.py, e.g. `kill -USR1 <pid>`
+PROFILE_SIGNAL = signal.SIGUSR1   # sample stacks for PROFILE_SECONDS, write a collapsed stack file
+STACKS_SIGNAL = signal.SIGUSR2    # dump the current stack of every thread
+MEMORY_SIGNAL = getattr(signal, 'SIGRTMIN', None)  # trace allocations for PROFILE_SECONDS (not on macOS)
+
+PROFILE_SECONDS = 10
+SAMPLE_INTERVAL = 0.005
+TOP_ALLOCATIONS = 30
+
+_busy = threading.Lock()
+
+
+def install(output_dir='.'):
+    """Installs the profiling signal handlers.
+
+    Nothing runs until a signal arrives, so the control loop pays nothing while idle.
+    """
+    signal.signal(PROFILE_SIGNAL, lambda signum, frame: _start(sample_stacks, output_dir))
+    signal.signal(STACKS_SIGNAL, lambda signum, frame: dump_stacks(output_dir))
+    if MEMORY_SIGNAL is not None:
+        signal.signal(MEMORY_SIGNAL, lambda signum, frame: _start(snapshot_allocations, output_dir))
+
+
+def _start(capture, output_dir):
+    # Signal handlers run on the main thread, so do the capture in the background
+    # and leave the control loop running. Only one capture at a time.
+    if not _busy.acquire(blocking=False):
+        print("Profiler already running")
+        return
+    def run():
+        try:
+            capture(output_dir)
+        finally:
+            _busy.release()
+    threading.Thread(target=run, name='profiler', daemon=True).start()
+
+
+def _output_filename(output_dir, kind, extension):
+    timestamp = time.strftime('%Y%m%d-%H%M%S')
+    return os.path.join(output_dir, '{}-{}-{}.{}'.format(kind, os.getpid(), timestamp, extension))
+
+
+def _thread_names():
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+
+def sample_stacks(output_dir='.', seconds=PROFILE_SECONDS, interval=SAMPLE_INTERVAL):
+    """Samples every other thread's stack and writes them in collapsed format.
+
+    Each line is "thread;outer;...;inner count", the input expected by flamegraph.pl
+    and speedscope.
+    """
+    own_id = threading.get_ident()
+    names = _thread_names()
+    counts = Counter()
+    end = time.time() + seconds
+    while time.time() < end:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+            if thread_id not in names:
+                names = _thread_names()
+            stack.append(names.get(thread_id, str(thread_id)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+
+    filename = _output_filename(output_dir, 'profile', 'collapsed')
+    with open(filename, 'w') as f:
+        for stack, count in counts.items():
+            f.write('{} {}\n'.format(stack, count))
+    print("Wrote {} samples to {}".format(sum(counts.values()), filename))
+
+
+def dump_stacks(output_dir='.'):
+    """Writes the current stack of every thread."""
+    names = _thread_names()
+    filename = _output_filename(output_dir, 'stacks', 'txt')
+    with open(filename, 'w') as f:
+        for thread_id, frame in sys._current_frames().items():
+            f.write('Thread {} ({}):\n'.format(names.get(thread_id, '?'), thread_id))
+            f.write(''.join(traceback.format_stack(frame)))
+            f.write('\n')
+    print("Wrote thread stacks to {}".format(filename))
+
+
+def snapshot_allocations(output_dir='.', seconds=PROFILE_SECONDS, top=TOP_ALLOCATIONS):
+    """Traces allocations for a window and writes the largest allocation sites.
+
+    tracemalloc slows every allocation down, so it only runs during the window.
+    """
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start()
+    time.sleep(seconds)
+    snapshot = tracemalloc.take_snapshot()
+    if not already_tracing:
+        tracemalloc.stop()
+
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    filename = _output_filename(output_dir, 'allocations', 'txt')
+    with open(filename, 'w') as f:
+        for stat in snapshot.statistics('lineno')[:top]:
+            f.write('{}\n'.format(stat))
+    print("Wrote allocation statistics to {}".format(filename))